@@ -1,56 +1,134 @@
 import subprocess
+import argparse
+import contextlib
+import functools
+import hashlib
 import json
-import re
 import os
+import shlex
 import shutil
-from typing import Any
+from pathlib import Path
+from typing import Any, Iterator, Optional
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def sui_client(command: str):
-    print(command)
+
+@functools.lru_cache(maxsize=None)
+def sui_binary() -> str:
+    # Resolved on first use only, and then once instead of on every call
+    sui = shutil.which("sui")
+    if sui is None:
+        raise SystemExit("Sui CLI not found, see https://docs.sui.io/guides/developer/getting-started/sui-install")
+    return sui
+
+def sui_client(command: list[str]):
+    print(shlex.join(command))
     try:
-        process = subprocess.run("sui client " + command + " --json", shell=True, check=True, stdout=subprocess.PIPE)
+        process = subprocess.run([sui_binary(), "client", *command, "--json"], check=True, stdout=subprocess.PIPE)
     except subprocess.CalledProcessError as e:
         print(e.stdout.decode())
         raise e
-    output = process.stdout.decode()
-    return json.loads(output)
+    if orjson is not None:
+        return orjson.loads(process.stdout)
+    return json.loads(process.stdout.decode())
 
-def build_atoma(path: str):
-    # Get the current path
-    pwd = os.getcwd()
+def move_call(package: str, module: str, function: str, *args: Any) -> list[str]:
+    return ["--move-call", f"{package}::{module}::{function}", *map(str, args)]
+
+def sui_client_ptb(calls: list[list[str]], gas_budget: int = 900000000):
+    # Submits the move calls together as one programmable transaction
+    # The CLI rejects a programmable transaction without any commands
+    if not calls:
+        return {"events": []}
+    command = [arg for call in calls for arg in call]
+    return sui_client(["ptb", *command, "--gas-budget", str(gas_budget)])
+
+def iter_events(output_json: dict[str, Any], event_type: str) -> Iterator[dict[str, Any]]:
+    return (event for event in output_json["events"] if event["type"].endswith(f"::{event_type}"))
 
+def events_of_type(output_json: dict[str, Any], event_type: str) -> list[dict[str, Any]]:
+    return list(iter_events(output_json, event_type))
+
+def first_event(output_json: dict[str, Any], event_type: str) -> dict[str, Any]:
+    event = next(iter_events(output_json, event_type), None)
+    if event is None:
+        raise SystemExit(f"No {event_type} in the Sui CLI response")
+    return event
+
+def source_hash(path: Path) -> str:
+    digest = hashlib.blake2b()
+    for file_path in [path / "Move.toml", *sorted((path / "sources").rglob("*.move"))]:
+        digest.update(file_path.relative_to(path).as_posix().encode())
+        digest.update(file_path.read_bytes())
+    return digest.hexdigest()
+
+@contextlib.contextmanager
+def working_directory(path: str):
+    # Return to the original path even if the body raises
+    pwd = os.getcwd()
     os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(pwd)
+
+def build_atoma(path: str):
+    package_dir = Path(path)
+    build_json = package_dir / "atoma_build.json"
+    build_meta = package_dir / "atoma_build.meta"
+
+    # The sources hash of the last publish, caches from before it was stored
+    # are reused as they are
+    src_hash = source_hash(package_dir)
+    built_hash = build_meta.read_text().strip() if build_meta.exists() else None
 
     # Build the Atoma package
-    if os.path.exists("atoma_build.json"):
-        output_json = json.load(open("atoma_build.json", "r"))
+    if build_json.exists() and built_hash in (None, src_hash):
+        output_json = json.loads(build_json.read_text())
+        # Adopt the current sources as the ones of a cache from before the
+        # hash was stored, so that changes from now on trigger a new publish
+        if built_hash is None:
+            build_meta.write_text(src_hash)
     else:
-        # Remove the build folder and Move.lock file
-        if os.path.exists("build"):
-            shutil.rmtree("build")
-        if os.path.exists("Move.lock"):
-            os.remove("Move.lock")
-        output_json = sui_client("publish --skip-dependency-verification --skip-fetch-latest-git-deps --gas-budget 900000000")
-        json.dump(output_json, open("atoma_build.json", "w"), indent=4)
-    atoma_package = output_json["events"][0]["packageId"]
-    atoma_db = output_json["events"][0]["parsedJson"]["db"]
-    atoma_manager_badge = output_json["events"][0]["parsedJson"]["manager_badge"]
-
-    # Return to the original path
-    os.chdir(pwd)
+        if built_hash is not None and built_hash != src_hash:
+            print("Atoma sources changed since the last publish, publishing a new package")
+        # Remove the build folder unless it was built from the same sources,
+        # and the Move.lock file
+        if built_hash != src_hash and (package_dir / "build").exists():
+            shutil.rmtree(package_dir / "build")
+        (package_dir / "Move.lock").unlink(missing_ok=True)
+        # Only publishing has to run from within the package
+        with working_directory(path):
+            output_json = sui_client(["publish", "--skip-dependency-verification", "--skip-fetch-latest-git-deps", "--gas-budget", "900000000"])
+        # Only the publish event is read back, the object changes and effects
+        # would just make every later run parse a much bigger file
+        output_json = {"events": [first_event(output_json, "PublishedEvent")]}
+        build_json.write_text(json.dumps(output_json, indent=4))
+        build_meta.write_text(src_hash)
+    published = first_event(output_json, "PublishedEvent")
+    atoma_package = published["packageId"]
+    atoma_db = published["parsedJson"]["db"]
+    atoma_manager_badge = published["parsedJson"]["manager_badge"]
+
     return atoma_package, atoma_db, atoma_manager_badge
 
 
-paths = [os.path.join("..", "packages"), os.path.join("sui", "packages")]
-atoma_paths = [os.path.join(path, "atoma") for path in paths]
+def find_atoma_path() -> Optional[str]:
+    # ATOMA_PKG_DIR skips probing the candidate paths and is passed on to any
+    # child process
+    paths = [os.path.join("..", "packages"), os.path.join("sui", "packages")]
+    atoma_paths = [os.path.join(path, "atoma") for path in paths]
+    if os.environ.get("ATOMA_PKG_DIR"):
+        atoma_paths = [os.environ["ATOMA_PKG_DIR"]]
+    atoma_path = next((path for path in atoma_paths if os.path.isdir(path)), None)
+    if atoma_path is not None:
+        os.environ["ATOMA_PKG_DIR"] = os.path.abspath(atoma_path)
+    return atoma_path
+
 
-atoma_package = atoma_db = atoma_manager_badge = None
-for atoma_path in atoma_paths:
-    if os.path.exists(atoma_path):
-        # If there is atoma_build.json it will reuse and not deploy new one
-        atoma_package, atoma_db, atoma_manager_badge = build_atoma(atoma_path)
-        break
 TEXT2TEXT = 0
 TEXT2IMAGE = 1
 INPUT_FEE_PER_TOKEN = 1
@@ -60,23 +138,54 @@ COLLATERAL = 1
 NODE_ECHELON = 1
 
 # Models (model_name, model_type, echelon)
-models = [("unsloth/Llama-3.2-1B-Instruct", TEXT2TEXT, 1)]
+DEFAULT_MODELS = [("unsloth/Llama-3.2-1B-Instruct", TEXT2TEXT, 1)]
+
+
+def main(models: list[tuple[str, int, int]]):
+    # Model names are put into PTB string literals as they are, without escaping
+    for model, model_type, echelon in models:
+        if '"' in model or "\\" in model:
+            raise SystemExit(f"Model name {model!r} cannot contain quotes or backslashes")
+
+    # Fail before doing anything if the Sui CLI is missing
+    sui_binary()
+
+    atoma_path = find_atoma_path()
+    if atoma_path is None:
+        raise SystemExit("Atoma package not found, run this script from the repository root or sui/dev, or point ATOMA_PKG_DIR at it")
+    # atoma_build.json is reused while the sources hash matches
+    # atoma_build.meta, otherwise a new package is published
+    atoma_package, atoma_db, atoma_manager_badge = build_atoma(atoma_path)
+
+    # Register the node and create all the tasks in one transaction
+    calls = [move_call(atoma_package, "db", "register_node_entry", f"@{atoma_db}")]
+    for model, model_type, echelon in models:
+        calls.append(move_call(
+            atoma_package, "db", "create_task_entry",
+            f"@{atoma_db}", f"@{atoma_manager_badge}", "0u16", f'some("{model}")', "some(0u16)", "some(50u8)", "true"
+        ))
+    output_json = sui_client_ptb(calls)
 
+    node_registered = first_event(output_json, "NodeRegisteredEvent")
+    node_badge = node_registered["parsedJson"]["badge_id"]
+    small_id = node_registered["parsedJson"]["node_small_id"]["inner"]
+    task_small_ids = [event["parsedJson"]["task_small_id"]["inner"] for event in events_of_type(output_json, "TaskRegisteredEvent")]
 
-output_json = sui_client(f'call --package "{atoma_package}" --module "db" --function "register_node_entry" --args "{atoma_db}" --gas-budget 900000000')
-node_badge = output_json["events"][0]["parsedJson"]["badge_id"]
-small_id = output_json["events"][0]["parsedJson"]["node_small_id"]["inner"]
+    # Subscribe the node to all the tasks in one transaction
+    if task_small_ids:
+        sui_client_ptb([
+            move_call(atoma_package, "db", "subscribe_node_to_task", f"@{atoma_db}", f"@{node_badge}", f"{task_small_id}u64", "10000000u64")
+            for task_small_id in task_small_ids
+        ])
 
-# Add models
-for model, model_type, echelon in models:
-    task = sui_client(
-        f'call --package "{atoma_package}" --module "db" --function "create_task_entry" --args "{atoma_db}" "{atoma_manager_badge}" 0 ["{model}"] ["0"] ["50"] true'
-    )
-    task_small_id = task["events"][0]["parsedJson"]["task_small_id"]["inner"]
+    print("Atoma_package: ", atoma_package)
+    print("Atoma_db: ", atoma_db)
+    print("Badge_id: ", node_badge)
+    print("Small_id: ", small_id)
 
-    sui_client(f'call --package "{atoma_package}" --module "db" --function "subscribe_node_to_task" --args "{atoma_db}" {node_badge} {task_small_id} 10000000')
 
-print("Atoma_package: ", atoma_package)
-print("Atoma_db: ", atoma_db)
-print("Badge_id: ", node_badge)
-print("Small_id: ", small_id)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publishes the Atoma package and registers a node subscribed to a task per model")
+    parser.add_argument("--model", action="append", dest="models", help="Text to text model to create a task for, can be repeated")
+    args = parser.parse_args()
+    main([(model, TEXT2TEXT, NODE_ECHELON) for model in args.models] if args.models else DEFAULT_MODELS)